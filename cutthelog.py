@@ -3,12 +3,13 @@
 """Print an unseen tailing part of a log file"""
 
 
-import argparse
+import errno
+import functools
 import logging
+import mmap
 import os
-import shutil
+import stat
 import sys
-import tempfile
 
 VERSION = (0, 9, 2)
 __version__ = '.'.join(map(str, VERSION))
@@ -16,6 +17,13 @@ DEFAULT_POSITION = (0, b'')
 LOG_FORMAT = '%(levelname)s: %(message)s'
 CACHE_DELIMITER = '##'
 EOL = b'\n'
+READ_CHUNK_SIZE = 1 << 16
+CACHE_CHUNK_SIZE = 1 << 20
+EOF_CHUNK_MAX_SIZE = 1 << 23
+PREFETCH_SIZE = 1 << 23
+KERNEL_COPY_MAX_SIZE = 1 << 30
+KERNEL_COPY_ERRNOS = (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EBADF, errno.EOPNOTSUPP,
+                      errno.ENOTSOCK)
 CACHE_FILENAME = '.cutthelog'
 HELPS = {
     'logfile': 'path of a file to print',
@@ -26,6 +34,7 @@ HELPS = {
 }
 NOT_FOUND = 'File "%s" not found'
 NO_PERMISSION = 'No permission to %s "%s"'
+_replace = getattr(os, 'replace', os.rename)
 
 
 class CutthelogError(Exception):
@@ -36,9 +45,161 @@ class CutthelogCacheError(CutthelogError):
     """Error of cache interaction"""
 
 
-class CutTheLog:
+def _find_cache_record(cache, file_prefix, start=0):
+    """Return start and end offsets of the first cache line starting with the prefix
+
+    The search is done by a single bytes scan over the whole cache content instead of
+    iterating over lines. If there is no such line the empty range at the end is returned
+
+    Parameters
+    ----------
+    cache : |bytes| or |mmap|
+        The cache content
+    file_prefix : |bytes|
+        The beginning of the file record
+    start : |int|, optional
+        The offset of a line start to search from
+    """
+    if cache[start:start + len(file_prefix)] != file_prefix:
+        start = cache.find(EOL + file_prefix, start) + 1 or len(cache)
+    end = cache.find(EOL, start) + 1 or len(cache)
+    return (start, end)
+
+
+def _copy_other_records(source, output, file_prefix):
+    """Copy cache lines except ones starting with the prefix
+
+    The source is memory-mapped, so the records to skip are found by a C-level scan
+    and the rest is written with one write call per a span between them. If the source
+    can't be mapped it's read by `CACHE_CHUNK_SIZE` blocks of whole lines"""
+    try:
+        cache = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        cache = None
+    if cache is not None:
+        try:
+            _write_other_records(output, cache, len(cache), file_prefix)
+        finally:
+            cache.close()
+        return
+    for block, block_end in _iter_line_blocks(source):
+        _write_other_records(output, block, block_end, file_prefix)
+
+
+def _read_cache_record(source, file_prefix):
+    """Return the offset and the content of the first cache line starting with the prefix
+
+    The source is read from its current position by `CACHE_CHUNK_SIZE` blocks of whole lines.
+    It's used if the cache can't be memory-mapped. If there is no such line the empty line
+    at the end is returned"""
+    offset = source.tell()
+    for block, block_end in _iter_line_blocks(source):
+        start, end = _find_cache_record(block, file_prefix)
+        if start < block_end:
+            return (offset + start, block[start:end])
+        offset += block_end
+    return (offset, b'')
+
+
+def _iter_line_blocks(source):
+    """Read a file by `CACHE_CHUNK_SIZE` chunks and yield blocks with the end of whole lines
+
+    The lines after the end are passed to the next block, only the last block may have
+    an incomplete line"""
+    tail = b''
+    for chunk in iter(functools.partial(source.read, CACHE_CHUNK_SIZE), b''):
+        block = tail + chunk
+        block_end = block.rfind(EOL) + 1
+        yield (block, block_end)
+        tail = block[block_end:]
+    yield (tail, len(tail))
+
+
+def _write_other_records(output, block, block_end, file_prefix):
+    position = 0
+    while position < block_end:
+        start, end = _find_cache_record(block, file_prefix, position)
+        start, end = min(start, block_end), min(end, block_end)
+        if start > position:
+            output.write(block[position:start])
+        position = end
+
+
+def _count_lines(path, end):
+    """Return the number of lines before the offset of a file
+
+    The file is read by `CACHE_CHUNK_SIZE` chunks. It's used only to report the line number
+    of a malformed cache record"""
+    count = 0
+    with open(path, 'rb') as fhandler:
+        while end > 0:
+            chunk = fhandler.read(min(CACHE_CHUNK_SIZE, end))
+            if not chunk:
+                break
+            count += chunk.count(EOL)
+            end -= len(chunk)
+    return count
+
+
+def _split_lines(chunk):
+    """Split a chunk to lines keeping EOL, only the last line may be incomplete
+
+    bytes.splitlines does the split in C but also breaks lines on carriage returns,
+    so it's used only for chunks without them"""
+    if b'\r' not in chunk:
+        return chunk.splitlines(True)
+    lines = [line + EOL for line in chunk.split(EOL)]
+    lines[-1] = lines[-1][:-len(EOL)]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def _is_same_line(line, other):
+    """Compare two lines ignoring a trailing EOL without making stripped copies of them"""
+    if len(line) - line.endswith(EOL) != len(other) - other.endswith(EOL):
+        return False
+    return line.startswith(other) if len(line) >= len(other) else other.startswith(line)
+
+
+def _open_for_read(path):
+    """Open a file for binary reading without updating its access time where it's possible
+
+    O_NOATIME is permitted only to the file owner so the file is reopened without it on EPERM"""
+    flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0) | getattr(os, 'O_CLOEXEC', 0)
+    noatime = getattr(os, 'O_NOATIME', 0)
+    try:
+        fd = os.open(path, flags | noatime)
+    except EnvironmentError as err:
+        if not noatime or err.errno != errno.EPERM:
+            raise
+        fd = os.open(path, flags)
+    return os.fdopen(fd, 'rb')
+
+
+def _pread(fhandler, size, offset):
+    """Read up to size bytes at the offset by a single os.pread call where it's available"""
+    if hasattr(os, 'pread'):
+        return os.pread(fhandler.fileno(), size, offset)
+    fhandler.seek(offset)
+    return fhandler.read(size)
+
+
+def _copy_file_range(out_fd, in_fd, offset, count):
+    """Copy data between files with os.copy_file_range called like os.sendfile"""
+    return os.copy_file_range(in_fd, out_fd, count, offset_src=offset)
+
+
+def _splice(out_fd, in_fd, offset, count):
+    """Move data from a file to a pipe with os.splice called like os.sendfile"""
+    return os.splice(in_fd, out_fd, count, offset_src=offset)
+
+
+class CutTheLog(object):
     """A class to read a single file from cache postition"""
 
+    __slots__ = ('path', '_path_bytes', '_cache_props', 'offset', 'last_line', 'fhandler')
+
     def __init__(self, path, offset=None, last_line=None):
         """An object initilization
 
@@ -51,7 +212,9 @@ class CutTheLog:
         last_line : |bytes|, optional
             The value of the last line read on the last interaction
         """
-        self.path = os.path.normpath(os.path.abspath(path))
+        self.path = os.path.abspath(path)
+        self._path_bytes = self.path.encode()
+        self._cache_props = {}
         self.offset = None
         self.last_line = None
         self.fhandler = None
@@ -90,17 +253,34 @@ class CutTheLog:
         """Open the file and check whether the position is correct
 
         If check fails and the position resets to the start of the file.
+        The file isn't read for the check on the default position or if it's too short
+        to contain the last line.
+        The kernel is advised that the rest of the file is read sequentially
+        and its first `PREFETCH_SIZE` bytes are needed soon.
         Return iterator over unseen byte lines"""
-        fhandler = open(self.path, 'rb')
+        fhandler = _open_for_read(self.path)
+        size = os.fstat(fhandler.fileno()).st_size
         offset, last_line = self.get_position()
-        try:
-            fhandler.seek(offset)
-            line = next(fhandler)
-            if line.rstrip(EOL) != last_line.rstrip(EOL):
-                raise StopIteration
-        except (IOError, StopIteration):
+        anchor = b''
+        if last_line and offset + max(len(last_line) - last_line.endswith(EOL), 1) <= size:
+            try:
+                anchor = _pread(fhandler, len(last_line) + 1, offset)
+            except EnvironmentError:
+                pass
+        line = anchor[:anchor.find(EOL) + 1] or anchor
+        if line and _is_same_line(line, last_line):
+            fhandler.seek(offset + len(line))
+        else:
             fhandler.seek(0)
             self.set_position()
+        if hasattr(os, 'posix_fadvise') and fhandler.tell() < size:
+            try:
+                os.posix_fadvise(fhandler.fileno(), fhandler.tell(), 0,
+                                 os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(fhandler.fileno(), fhandler.tell(), PREFETCH_SIZE,
+                                 os.POSIX_FADV_WILLNEED)
+            except EnvironmentError:
+                pass
         self.fhandler = fhandler
         return iter(self)
 
@@ -116,46 +296,172 @@ class CutTheLog:
         """Iterator over lines of the file
 
         It's intended only for using inside the __enter__ method
-        when the file is opened"""
+        when the file is opened. The file is read by chunks of `READ_CHUNK_SIZE` bytes
+        and split to lines by EOL in C so there is no per-line buffered reading.
+        The position is moved by the byte cursor counted from the file position"""
         if not self.is_file_opened():
             return
-        offset_change = len(self.last_line)
-        for line in self.fhandler:
-            self.offset += offset_change
-            self.last_line = line
-            yield line
-            offset_change = len(line)
+        cursor = self.fhandler.tell()
+        pending = []
+        for chunk in iter(functools.partial(self.fhandler.read, READ_CHUNK_SIZE), b''):
+            lines = _split_lines(chunk)
+            if pending:
+                pending.append(lines[0])
+                if not lines[0].endswith(EOL):
+                    continue
+                lines[0] = b''.join(pending)
+                pending = []
+            if not lines[-1].endswith(EOL):
+                pending.append(lines.pop())
+            for line in lines:
+                self.offset, self.last_line = cursor, line
+                cursor += len(line)
+                yield line
+        if pending:
+            self.offset, self.last_line = cursor, b''.join(pending)
+            yield self.last_line
+
+    def copy_to(self, output):
+        """Write unseen part of the file to a binary file object by chunks
+
+        It's intended only for using inside the with statement instead of the line iterator
+        when lines don't need to be processed one by one. The position is moved to the last
+        line written to the output. If the data can't be copied by the kernel it's read
+        to a single reusable buffer of `READ_CHUNK_SIZE` bytes
+
+        Parameters
+        ----------
+        output : |file|
+            A binary file object to write to
+        """
+        if not self.is_file_opened():
+            return
+        if self.fhandler.tell() >= os.fstat(self.fhandler.fileno()).st_size:
+            return
+        if self._copy_in_kernel(output):
+            return
+        line_start = self.fhandler.tell()
+        pending = []
+        buf = bytearray(READ_CHUNK_SIZE)
+        size = self.fhandler.readinto(buf)
+        while size:
+            output.write(buf if size == READ_CHUNK_SIZE else buf[:size])
+            last_line_pos = buf.rfind(EOL, 0, size - 1) + 1
+            if last_line_pos > 0:
+                line_start += sum(map(len, pending)) + last_line_pos
+                pending = [bytes(buf[last_line_pos:size])]
+            elif pending and not pending[-1].endswith(EOL):
+                pending.append(bytes(buf[:size]))
+            else:
+                line_start += sum(map(len, pending))
+                pending = [bytes(buf[:size])]
+            size = self.fhandler.readinto(buf)
+        if pending:
+            self.set_position(line_start, b''.join(pending))
+
+    def _copy_in_kernel(self, output):
+        """Copy the rest of the file to the output with a kernel copy function
+
+        The copy is done by the kernel without reading the data to userspace:
+        os.copy_file_range is tried for a regular output file, os.splice for a pipe
+        and os.sendfile for any output descriptor. A function failing on the first call
+        with one of `KERNEL_COPY_ERRNOS` is replaced by the next one.
+        The last line is found by reading back from the copy end on the opened file,
+        usually by a single pread call.
+        Return False if the output doesn't allow that and nothing was copied"""
+        try:
+            out_fd = output.fileno()
+        except (AttributeError, ValueError, EnvironmentError):
+            return False
+        mode = os.fstat(out_fd).st_mode
+        copy_functions = []
+        if stat.S_ISREG(mode) and hasattr(os, 'copy_file_range'):
+            copy_functions.append(_copy_file_range)
+        if stat.S_ISFIFO(mode) and hasattr(os, 'splice'):
+            copy_functions.append(_splice)
+        if hasattr(os, 'sendfile'):
+            copy_functions.append(os.sendfile)
+        output.flush()
+        in_fd = self.fhandler.fileno()
+        start = offset = self.fhandler.tell()
+        while copy_functions:
+            try:
+                copied = copy_functions[0](out_fd, in_fd, offset, KERNEL_COPY_MAX_SIZE)
+            except EnvironmentError as err:
+                if offset > start or err.errno not in KERNEL_COPY_ERRNOS:
+                    raise
+                copy_functions.pop(0)
+                continue
+            if not copied:
+                break
+            offset += copied
+        if not copy_functions:
+            return False
+        if offset > start:
+            self.set_position(*self._get_eof_position_by_chunks(self.fhandler, offset))
+        return True
 
     def get_eof_position(self):
         """Return offset and value of the last line without reading of the whole file
 
+        A file larger than `READ_CHUNK_SIZE` is memory-mapped and searched backward for EOL,
+        a smaller one is read by a single chunk
+
         Raises
         ------
         EnvironmentError
             On failed file opening or reading
         """
-        chunk_size = 512
-        last_line_chunks = []
-        with open(self.path, 'rb') as fhandler:
+        with _open_for_read(self.path) as fhandler:
             fhandler.seek(0, os.SEEK_END)
-            offset = fhandler.tell()
-            while offset > 0:
-                step = min(chunk_size, offset)
-                offset -= step
-                fhandler.seek(offset, os.SEEK_SET)
-                chunk = fhandler.read(step)
-                start, end = (None, None) if last_line_chunks else (0, step - 1)
-                last_line_pos = chunk.rfind(EOL, start, end) + 1
-                if last_line_pos > 0:
-                    offset += last_line_pos
-                    last_line_chunks.append(chunk[last_line_pos:])
-                    break
-                last_line_chunks.append(chunk)
-        return (offset, b''.join(reversed(last_line_chunks)))
+            size = fhandler.tell()
+            if size <= READ_CHUNK_SIZE:
+                return self._get_eof_position_by_chunks(fhandler, size)
+            try:
+                content = mmap.mmap(fhandler.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError, OverflowError):
+                return self._get_eof_position_by_chunks(fhandler, size)
+            if hasattr(mmap, 'MADV_RANDOM'):
+                content.madvise(mmap.MADV_RANDOM)
+            try:
+                offset = content.rfind(EOL, 0, size - 1) + 1
+                return (offset, content[offset:])
+            finally:
+                content.close()
+
+    @staticmethod
+    def _get_eof_position_by_chunks(fhandler, offset):
+        """Find the last line before the offset by reading the file backward by chunks
+
+        It's used for small files, files which can't be memory-mapped and
+        by the kernel copy when the file is already opened. The chunk size starts from
+        `READ_CHUNK_SIZE` and doubles on every step up to `EOF_CHUNK_MAX_SIZE`.
+        The chunks are dropped after the search and a line longer than the first chunk
+        is read by one more call, so the memory used doesn't grow beyond the line size"""
+        end = offset
+        chunk_size = READ_CHUNK_SIZE
+        chunk = b''
+        while offset > 0:
+            step = min(chunk_size, offset)
+            offset -= step
+            chunk = _pread(fhandler, step, offset)
+            chunk_size = min(chunk_size * 2, EOF_CHUNK_MAX_SIZE)
+            last_line_pos = chunk.rfind(EOL, 0, end - offset - 1) + 1
+            if last_line_pos > 0:
+                offset += last_line_pos
+                chunk = chunk[last_line_pos:]
+                break
+        if offset + len(chunk) < end:
+            chunk = _pread(fhandler, end - offset, offset)
+        return (offset, chunk)
 
     def _get_cache_props(self, delimiter):
         delimiter = delimiter or CACHE_DELIMITER
-        return (self.path.encode() + delimiter.encode(), delimiter.encode())
+        props = self._cache_props.get(delimiter)
+        if props is None:
+            encoded = delimiter.encode()
+            props = self._cache_props[delimiter] = (self._path_bytes + encoded, encoded)
+        return props
 
     def set_position_from_cache(self, cache_file, delimiter=None):
         """Set the internal position from cache file
@@ -165,7 +471,9 @@ class CutTheLog:
         <normalized absolute file path><delimiter><offset value><delimiter><last line value>
 
         There is no need to parse every cache line so we search only the required one
-        and don't use the csv module
+        and don't use the csv module. The first line is checked before the whole cache is
+        searched because records of the last read files are stored at the start of the cache.
+        The cache is memory-mapped for the search or read by blocks if it can't be mapped
 
         Parameters
         ----------
@@ -182,28 +490,53 @@ class CutTheLog:
         file_prefix, delimiter = self._get_cache_props(delimiter)
         try:
             with open(cache_file, 'rb') as fhandler:
-                line_iter = ((index, line) for index, line in enumerate(fhandler)
-                             if line.startswith(file_prefix))
-                index, line = next(line_iter, (None, None))
-                if line is not None:
-                    splitted_line = line.split(delimiter, 2)
-                    if len(splitted_line) == 3:
-                        try:
-                            self.set_position(int(splitted_line[1]), splitted_line[2])
-                        except ValueError:
-                            msg = 'Bad offset {} in line #{}'.format(splitted_line[1], index)
-                            raise CutthelogCacheError(msg)
+                line = fhandler.readline()
+                start = 0
+                if not line.startswith(file_prefix):
+                    if os.fstat(fhandler.fileno()).st_size <= len(line):
+                        return
+                    try:
+                        cache = mmap.mmap(fhandler.fileno(), 0, access=mmap.ACCESS_READ)
+                    except (EnvironmentError, ValueError):
+                        start, line = _read_cache_record(fhandler, file_prefix)
                     else:
-                        msg = 'Malformed cache line #{}: {}'.format(index, line.rstrip())
-                        raise CutthelogCacheError(msg)
+                        try:
+                            start, end = _find_cache_record(cache, file_prefix, len(line))
+                            line = cache[start:end]
+                        finally:
+                            cache.close()
+        except EnvironmentError as err:
+            raise CutthelogCacheError('Failed to read cache: ' + str(err))
+        if not line:
+            return
+        offset_end = line.find(delimiter, len(file_prefix))
+        if offset_end < 0:
+            index = self._get_cache_line_index(cache_file, start)
+            msg = 'Malformed cache line #{}: {}'.format(index, line.rstrip())
+            raise CutthelogCacheError(msg)
+        offset = line[len(file_prefix):offset_end]
+        last_line = line[offset_end + len(delimiter):]
+        try:
+            self.set_position(int(offset), last_line)
+        except ValueError:
+            index = self._get_cache_line_index(cache_file, start)
+            msg = 'Bad offset {} in line #{}'.format(offset, index)
+            raise CutthelogCacheError(msg)
+
+    @staticmethod
+    def _get_cache_line_index(cache_file, start):
+        try:
+            return _count_lines(cache_file, start)
         except EnvironmentError as err:
             raise CutthelogCacheError('Failed to read cache: ' + str(err))
 
     def save_to_cache(self, cache_file, delimiter=None):
         """Save position of the file to cache
 
-        At first the file record is written to temporary file, then records of other files are
-        appended and finally the temporary file is copyed to the original cache path
+        At first the file record is written to temporary file in the cache directory, then records
+        of other files are appended and finally the temporary file replaces the original cache
+        in one rename, so the cache is never left half-written. If the cache directory isn't
+        writable the cache is rewritten in place
         As a result records of the last read file are stored at the start of the cache so they are
         found faster on the next run
 
@@ -219,32 +552,61 @@ class CutTheLog:
         `CutthelogCacheError`
             On failed cache reading or malformed cache record for the file
         """
+        import shutil
+        import tempfile
+
         file_prefix, delimiter = self._get_cache_props(delimiter)
-        offset, last_line = self.get_position()
+        cache_path = os.path.realpath(cache_file)
         try:
-            with tempfile.NamedTemporaryFile(mode='wb') as fhandler:
-                fhandler.write(self.path.encode())
-                fhandler.write(delimiter)
-                fhandler.write(str(offset).encode())
-                fhandler.write(delimiter)
-                fhandler.write(last_line)
-                if not last_line.endswith(EOL):
-                    fhandler.write(EOL)
-                try:
-                    with open(cache_file, 'rb') as source_fhandler:
-                        for line in source_fhandler:
-                            if not line.startswith(file_prefix):
-                                fhandler.write(line)
-                except EnvironmentError:
-                    pass
-                fhandler.flush()
-                shutil.copyfile(fhandler.name, cache_file)
+            try:
+                fd, temp_path = tempfile.mkstemp(prefix='.cutthelog.',
+                                                 dir=os.path.dirname(cache_path))
+            except EnvironmentError:
+                self._rewrite_cache(cache_path, file_prefix, delimiter)
+                return
+            try:
+                with os.fdopen(fd, 'wb') as fhandler:
+                    self._write_cache_record(fhandler, delimiter)
+                    try:
+                        source_fhandler = open(cache_path, 'rb')
+                    except EnvironmentError as err:
+                        if err.errno != errno.ENOENT:
+                            raise
+                        source_fhandler = None
+                    if source_fhandler is not None:
+                        with source_fhandler:
+                            _copy_other_records(source_fhandler, fhandler, file_prefix)
+                    fhandler.flush()
+                    os.fsync(fhandler.fileno())
+                if os.path.exists(cache_path):
+                    shutil.copymode(cache_path, temp_path)
+                _replace(temp_path, cache_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
         except EnvironmentError as err:
             msg = 'Failed to save cache: ' + str(err)
             raise CutthelogCacheError(msg)
 
+    def _rewrite_cache(self, cache_path, file_prefix, delimiter):
+        """Rewrite the cache file in place holding records of other files in memory"""
+        with open(cache_path, 'r+b') as fhandler:
+            content = fhandler.read()
+            fhandler.seek(0)
+            self._write_cache_record(fhandler, delimiter)
+            _write_other_records(fhandler, content, len(content), file_prefix)
+            fhandler.truncate()
+
+    def _write_cache_record(self, fhandler, delimiter):
+        offset, last_line = self.get_position()
+        eol = b'' if last_line.endswith(EOL) else EOL
+        fhandler.write(b''.join((self._path_bytes, delimiter, b'%d' % offset, delimiter,
+                                 last_line, eol)))
+
 
 def argument_parsing():
+    import argparse
+
     parser = argparse.ArgumentParser(description=__doc__)
     main_group = parser.add_mutually_exclusive_group(required=True)
     main_group.add_argument('logfile', help=HELPS['logfile'], nargs='?')
@@ -298,6 +660,9 @@ def main():
 
     It uses the basic function `CutTheLog` object. See description in README.rst
     """
+    if sys.argv[1:] in (['-V'], ['--version']):
+        print(__version__)
+        return 0
     args = argument_parsing()
     if args.version:
         print(__version__)
@@ -315,9 +680,9 @@ def main():
         return 74
     initial_position = cutthelog.get_position()
     try:
-        with cutthelog as line_iter:
+        with cutthelog:
             stdout = sys.stdout.buffer if hasattr(sys.stdout, 'buffer') else sys.stdout
-            stdout.writelines(line_iter)
+            cutthelog.copy_to(stdout)
     except EnvironmentError as err:
         logging.error('Failed to read file: %s', err)
         return 74
@@ -1,25 +1,35 @@
 # -*- coding: utf-8 -*-
 
 
+import collections
+import contextlib
+import errno
+import functools
+import io
+import itertools
+import logging
 import os
-import shlex
 import shutil
+import socket
 import subprocess
+import sys
 import tempfile
 import unittest
+from unittest import mock
 
 import cutthelog as ctl
 
 DATADIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
 CACHE_FILE = os.path.join(DATADIR, 'cache')
-TEST_POSITIONS = (ctl.DEFAULT_POSITION, (10, b'abc'), (11111, b'xyz'))
+Position = collections.namedtuple('Position', 'offset last_line')
+TEST_POSITIONS = (Position(*ctl.DEFAULT_POSITION), Position(10, b'abc'), Position(11111, b'xyz'))
 NAME = 'empty'
 ONE_LINE_NAME = 'one_line'
 TWO_LINES_NAME = 'two_lines'
 THREE_LINES_NAME = 'three_lines'
 LONG_LINE_NAME = 'long_line'
 TWO_LONG_LINES_NAME = 'two_long_lines'
-LONG_LINE = b''.join(str(i).encode() for i in range(1, 501)) + ctl.EOL
+LONG_LINE = ''.join(map(str, range(1, 501))).encode() + ctl.EOL
 LINES = (b'Hello, world!\n', b'Bye, world\n', b'Hello again')
 ONE_LINE_POSITION = (0, LINES[0])
 TWO_LINES_POSITION = (len(LINES[0]), LINES[1])
@@ -27,10 +37,12 @@ THREE_LINES_POSITION = (len(LINES[0]) + len(LINES[1]), LINES[2])
 
 
 with open(CACHE_FILE, 'rb') as cache_handler:
-    CACHE_LINES = list(cache_handler)
-CACHE_CONTENT = b''.join(CACHE_LINES)
+    CACHE_CONTENT = cache_handler.read()
+CACHE_LINES = CACHE_CONTENT.splitlines(True)
+HELLO_FIRST_CACHE_CONTENT = b''.join(CACHE_LINES[2:3] + CACHE_LINES[:2] + CACHE_LINES[3:])
 
 
+@functools.lru_cache(maxsize=None)
 def get_data_file_path(filename):
     return os.path.join(DATADIR, filename)
 
@@ -41,6 +53,25 @@ def get_object(path=NAME, offset=None, last_line=None):
 
 
 class TestClass(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cache_dir = tempfile.mkdtemp(prefix='cutthelog_')
+        cls.cache_file = os.path.join(cls.cache_dir, 'cache')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.cache_dir)
+
+    def assert_iter_equals(self, line_iter, expected):
+        for line in expected:
+            self.assertEqual(next(line_iter), line)
+        self.assertRaises(StopIteration, next, line_iter)
+
+    def get_cache_file(self):
+        with open(self.cache_file, 'wb') as fhandler:
+            fhandler.write(CACHE_CONTENT)
+        return self.cache_file
+
     def test_init(self):
         obj = get_object()
         self.assertEqual(obj.path, get_data_file_path(NAME))
@@ -57,9 +88,11 @@ class TestClass(unittest.TestCase):
         self.assertEqual(obj.get_position(), ctl.DEFAULT_POSITION)
         obj.set_position()
         self.assertEqual(obj.get_position(), ctl.DEFAULT_POSITION)
+        positions = []
         for pos in TEST_POSITIONS:
             obj.set_position(*pos)
-            self.assertEqual(obj.get_position(), pos)
+            positions.append(obj.get_position())
+        self.assertEqual(positions, list(TEST_POSITIONS))
         obj.set_position()
         self.assertEqual(obj.get_position(), ctl.DEFAULT_POSITION)
 
@@ -67,9 +100,8 @@ class TestClass(unittest.TestCase):
         obj = get_object()
         obj()
         self.assertEqual(obj.get_position(), ctl.DEFAULT_POSITION)
-        for pos in TEST_POSITIONS:
-            obj(*pos)
-            self.assertEqual(obj.get_position(), pos)
+        positions = [obj(*pos).get_position() for pos in TEST_POSITIONS]
+        self.assertEqual(positions, list(TEST_POSITIONS))
         obj()
         self.assertEqual(obj.get_position(), ctl.DEFAULT_POSITION)
 
@@ -91,29 +123,23 @@ class TestClass(unittest.TestCase):
         self.assertEqual(obj.get_position(), ctl.DEFAULT_POSITION)
         self.assertTrue(obj.fhandler.closed)
 
-    def test_one_line_file(self):
-        obj = get_object(ONE_LINE_NAME)
-        self.assertEqual(obj.get_position(), ctl.DEFAULT_POSITION)
-        with obj as line_iter:
-            self.assertEqual(next(line_iter), LINES[0])
-            with self.assertRaises(StopIteration):
-                next(line_iter)
-        self.assertEqual(obj.get_position(), ONE_LINE_POSITION)
-        with obj as line_iter:
-            with self.assertRaises(StopIteration):
-                next(line_iter)
-        self.assertEqual(obj.get_position(), ONE_LINE_POSITION)
-
-    def test_two_lines_file(self):
-        obj = get_object(TWO_LINES_NAME)
-        self.assertEqual(obj.get_position(), ctl.DEFAULT_POSITION)
-        with obj as line_iter:
-            self.assertEqual(tuple(line_iter), LINES[:2])
-        self.assertEqual(obj.get_position(), TWO_LINES_POSITION)
-        with obj as line_iter:
-            with self.assertRaises(StopIteration):
-                next(line_iter)
-        self.assertEqual(obj.get_position(), TWO_LINES_POSITION)
+    def test_read_whole_file(self):
+        cases = (
+            (NAME, (), ctl.DEFAULT_POSITION),
+            (ONE_LINE_NAME, LINES[:1], ONE_LINE_POSITION),
+            (TWO_LINES_NAME, LINES[:2], TWO_LINES_POSITION),
+            (THREE_LINES_NAME, LINES, THREE_LINES_POSITION),
+            (TWO_LONG_LINES_NAME, (LONG_LINE, LONG_LINE[1:]), (len(LONG_LINE), LONG_LINE[1:])),
+        )
+        for filename, lines, position in cases:
+            with self.subTest(filename=filename):
+                obj = get_object(filename)
+                with obj as line_iter:
+                    self.assert_iter_equals(line_iter, lines)
+                self.assertEqual(obj.get_position(), position)
+                with obj as line_iter:
+                    self.assert_iter_equals(line_iter, ())
+                self.assertEqual(obj.get_position(), position)
 
     def test_with_statement_with_valid_position(self):
         obj = get_object(TWO_LINES_NAME)
@@ -132,6 +158,12 @@ class TestClass(unittest.TestCase):
             self.assertEqual(obj.get_position(), ctl.DEFAULT_POSITION)
             self.assertEqual(next(line_iter), LINES[0])
 
+    def test_with_statement_with_partial_last_line(self):
+        obj = get_object(TWO_LINES_NAME)
+        with obj(offset=0, last_line=LINES[0][:5]) as line_iter:
+            self.assertEqual(obj.get_position(), ctl.DEFAULT_POSITION)
+            self.assertEqual(next(line_iter), LINES[0])
+
     def test_with_statement_with_invalid_position_value(self):
         obj = get_object(TWO_LINES_NAME)
         with obj(offset=4, last_line=ONE_LINE_POSITION[1]) as line_iter:
@@ -159,11 +191,119 @@ class TestClass(unittest.TestCase):
             self.assertEqual(next(line_iter), LINES[1])
         self.assertEqual(obj.get_position(), TWO_LINES_POSITION)
 
-    def test_file_witout_eol_before_eof(self):
+    def test_lines_across_read_chunks(self):
+        chunk_size = ctl.READ_CHUNK_SIZE
+        self.addCleanup(setattr, ctl, 'READ_CHUNK_SIZE', chunk_size)
+        ctl.READ_CHUNK_SIZE = 5
         obj = get_object(THREE_LINES_NAME)
         with obj as line_iter:
-            self.assertEqual(tuple(line_iter), LINES[:3])
+            self.assert_iter_equals(line_iter, LINES[:3])
         self.assertEqual(obj.get_position(), THREE_LINES_POSITION)
+        obj = get_object(TWO_LONG_LINES_NAME)
+        with obj as line_iter:
+            self.assert_iter_equals(line_iter, (LONG_LINE, LONG_LINE[1:]))
+        self.assertEqual(obj.get_position(), (len(LONG_LINE), LONG_LINE[1:]))
+
+    def test_split_lines(self):
+        self.assertEqual(ctl._split_lines(b'a\nb\n'), [b'a\n', b'b\n'])
+        self.assertEqual(ctl._split_lines(b'a\nb'), [b'a\n', b'b'])
+        self.assertEqual(ctl._split_lines(b'\n'), [b'\n'])
+        self.assertEqual(ctl._split_lines(b'a\r\nb\rc\n'), [b'a\r\n', b'b\rc\n'])
+        self.assertEqual(ctl._split_lines(b'a\r\nb\rc'), [b'a\r\n', b'b\rc'])
+
+    def test_is_same_line(self):
+        self.assertTrue(ctl._is_same_line(b'line\n', b'line\n'))
+        self.assertTrue(ctl._is_same_line(b'line\n', b'line'))
+        self.assertTrue(ctl._is_same_line(b'line', b'line\n'))
+        self.assertTrue(ctl._is_same_line(b'line', b'line'))
+        self.assertFalse(ctl._is_same_line(b'line\n', b'lime\n'))
+        self.assertFalse(ctl._is_same_line(b'line\n', b'lin'))
+        self.assertFalse(ctl._is_same_line(b'line', b'line\r'))
+
+    def test_copy_to(self):
+        chunk_size = ctl.READ_CHUNK_SIZE
+        self.addCleanup(setattr, ctl, 'READ_CHUNK_SIZE', chunk_size)
+        cases = (
+            (NAME, b'', ctl.DEFAULT_POSITION),
+            (ONE_LINE_NAME, LINES[0], ONE_LINE_POSITION),
+            (THREE_LINES_NAME, b''.join(LINES), THREE_LINES_POSITION),
+            (TWO_LONG_LINES_NAME, LONG_LINE + LONG_LINE[1:], (len(LONG_LINE), LONG_LINE[1:])),
+        )
+        for size in (1, 5, 14, chunk_size):
+            ctl.READ_CHUNK_SIZE = size
+            for filename, content, position in cases:
+                obj = get_object(filename)
+                output = io.BytesIO()
+                with obj:
+                    obj.copy_to(output)
+                self.assertEqual(output.getvalue(), content)
+                self.assertEqual(obj.get_position(), position)
+        obj = get_object(TWO_LINES_NAME, *ONE_LINE_POSITION)
+        output = io.BytesIO()
+        with obj:
+            obj.copy_to(output)
+        self.assertEqual(output.getvalue(), LINES[1])
+        self.assertEqual(obj.get_position(), TWO_LINES_POSITION)
+
+    def test_copy_to_regular_file(self):
+        obj = get_object(TWO_LINES_NAME, *ONE_LINE_POSITION)
+        with tempfile.TemporaryFile() as output:
+            output.write(LINES[2])
+            with obj:
+                obj.copy_to(output)
+            output.seek(0)
+            self.assertEqual(output.read(), LINES[2] + LINES[1])
+        self.assertEqual(obj.get_position(), TWO_LINES_POSITION)
+        obj = get_object(THREE_LINES_NAME)
+        with tempfile.TemporaryFile() as output:
+            with obj:
+                obj.copy_to(output)
+            output.seek(0)
+            self.assertEqual(output.read(), b''.join(LINES))
+        self.assertEqual(obj.get_position(), THREE_LINES_POSITION)
+        obj = get_object(TWO_LINES_NAME, *ONE_LINE_POSITION)
+        with tempfile.NamedTemporaryFile() as fhandler:
+            fhandler.write(LINES[2])
+            fhandler.flush()
+            with open(fhandler.name, 'ab') as output:
+                with obj:
+                    obj.copy_to(output)
+            self.assertEqual(fhandler.read(), LINES[1])
+        self.assertEqual(obj.get_position(), TWO_LINES_POSITION)
+
+    def test_copy_to_without_kernel_copy(self):
+        obj = get_object(TWO_LINES_NAME, *ONE_LINE_POSITION)
+        no_copy_file_range = OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+        no_sendfile = OSError(errno.ENOTSOCK, os.strerror(errno.ENOTSOCK))
+        with mock.patch('os.copy_file_range', side_effect=no_copy_file_range, create=True), \
+                mock.patch('os.sendfile', side_effect=no_sendfile, create=True) as sendfile:
+            with tempfile.TemporaryFile() as output:
+                with obj:
+                    obj.copy_to(output)
+                output.seek(0)
+                self.assertEqual(output.read(), LINES[1])
+        self.assertTrue(sendfile.called)
+        self.assertEqual(obj.get_position(), TWO_LINES_POSITION)
+
+    def test_copy_to_pipe(self):
+        obj = get_object(TWO_LINES_NAME, *ONE_LINE_POSITION)
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(read_fd, 'rb') as reader:
+            with os.fdopen(write_fd, 'wb') as output:
+                with obj:
+                    obj.copy_to(output)
+            self.assertEqual(reader.read(), LINES[1])
+        self.assertEqual(obj.get_position(), TWO_LINES_POSITION)
+
+    def test_copy_to_socket(self):
+        obj = get_object(TWO_LINES_NAME, *ONE_LINE_POSITION)
+        reader, writer = socket.socketpair()
+        with contextlib.closing(reader):
+            with contextlib.closing(writer), writer.makefile('wb') as output:
+                with obj:
+                    obj.copy_to(output)
+            self.assertEqual(reader.recv(1024), LINES[1])
+        self.assertEqual(obj.get_position(), TWO_LINES_POSITION)
 
     def test_position_in_file_witout_eol_before_eof(self):
         obj = get_object(THREE_LINES_NAME)
@@ -174,14 +314,35 @@ class TestClass(unittest.TestCase):
         self.assertEqual(obj.get_position(), THREE_LINES_POSITION)
 
     def test_get_eof_position(self):
-        obj = get_object(NAME)
-        self.assertEqual(obj.get_eof_position(), ctl.DEFAULT_POSITION)
-        obj = get_object(ONE_LINE_NAME)
-        self.assertEqual(obj.get_eof_position(), ONE_LINE_POSITION)
-        obj = get_object(TWO_LINES_NAME)
-        self.assertEqual(obj.get_eof_position(), TWO_LINES_POSITION)
-        obj = get_object(THREE_LINES_NAME)
-        self.assertEqual(obj.get_eof_position(), THREE_LINES_POSITION)
+        expected = {
+            NAME: ctl.DEFAULT_POSITION,
+            ONE_LINE_NAME: ONE_LINE_POSITION,
+            TWO_LINES_NAME: TWO_LINES_POSITION,
+            THREE_LINES_NAME: THREE_LINES_POSITION,
+        }
+        positions = {name: get_object(name).get_eof_position() for name in expected}
+        self.assertEqual(positions, expected)
+
+    def test_get_eof_position_with_mmap(self):
+        chunk_size = ctl.READ_CHUNK_SIZE
+        self.addCleanup(setattr, ctl, 'READ_CHUNK_SIZE', chunk_size)
+        ctl.READ_CHUNK_SIZE = 1
+        self.test_get_eof_position()
+        self.test_get_eof_position_on_long_lines()
+
+    def test_get_eof_position_by_chunks(self):
+        chunk_size = ctl.READ_CHUNK_SIZE
+        self.addCleanup(setattr, ctl, 'READ_CHUNK_SIZE', chunk_size)
+        for size in (1, 5, 512, chunk_size):
+            ctl.READ_CHUNK_SIZE = size
+            for filename, position in ((ONE_LINE_NAME, ONE_LINE_POSITION),
+                                       (THREE_LINES_NAME, THREE_LINES_POSITION),
+                                       (LONG_LINE_NAME, (0, LONG_LINE)),
+                                       (TWO_LONG_LINES_NAME, (len(LONG_LINE), LONG_LINE[1:]))):
+                with open(get_data_file_path(filename), 'rb') as fhandler:
+                    end = os.fstat(fhandler.fileno()).st_size
+                    self.assertEqual(ctl.CutTheLog._get_eof_position_by_chunks(fhandler, end),
+                                     position)
 
     def test_get_eof_position_on_long_lines(self):
         obj = get_object(LONG_LINE_NAME)
@@ -200,42 +361,148 @@ class TestClass(unittest.TestCase):
                 pass
 
     def test_set_position_from_cache(self):
-        def check(filename, check_res, delimiter=None):
-            obj = get_object(filename)
-            obj.set_position_from_cache(CACHE_FILE, delimiter=delimiter)
-            self.assertEqual(obj.get_position(), check_res)
-        check('/root/hello', (50, b'Hello, world\n'))
-        check('/root/hello.2', (100, b'Hello, world!\n'))
-        check('/root/hello.3', (200, b'Hello##world!\n'))
-        check('/root/no_such_file_in_cache', ctl.DEFAULT_POSITION)
-        with self.assertRaises(ctl.CutthelogCacheError):
-            check('/root/bad_format', ctl.DEFAULT_POSITION)
-        with self.assertRaises(ctl.CutthelogCacheError):
-            check('/root/bad_offset', ctl.DEFAULT_POSITION)
-        check('/root/unable_to_find', ctl.DEFAULT_POSITION)
-        check('/root/hello', (60, b'Hello, world\n'), delimiter='%%')
+        cases = (
+            ('/root/hello', (50, b'Hello, world\n'), None),
+            ('/root/hello.2', (100, b'Hello, world!\n'), None),
+            ('/root/hello.3', (200, b'Hello##world!\n'), None),
+            ('/root/no_such_file_in_cache', ctl.DEFAULT_POSITION, None),
+            ('/root/unable_to_find', ctl.DEFAULT_POSITION, None),
+            ('/root/hello', (60, b'Hello, world\n'), '%%'),
+        )
+        for filename, position, delimiter in cases:
+            with self.subTest(filename=filename, delimiter=delimiter):
+                obj = get_object(filename)
+                obj.set_position_from_cache(CACHE_FILE, delimiter=delimiter)
+                self.assertEqual(obj.get_position(), position)
+        for filename, index in (('/root/bad_format', 3), ('/root/bad_offset', 4)):
+            with self.subTest(filename=filename):
+                with self.assertRaisesRegex(ctl.CutthelogCacheError, 'line #{}'.format(index)):
+                    get_object(filename).set_position_from_cache(CACHE_FILE)
+
+    def test_set_position_from_cache_without_mmap(self):
+        chunk_size = ctl.CACHE_CHUNK_SIZE
+        self.addCleanup(setattr, ctl, 'CACHE_CHUNK_SIZE', chunk_size)
+        cases = (
+            ('/root/hello.3', (200, b'Hello##world!\n')),
+            ('/root/hello', (50, b'Hello, world\n')),
+            ('/root/unable_to_find', ctl.DEFAULT_POSITION),
+            ('/root/no_such_file_in_cache', ctl.DEFAULT_POSITION),
+        )
+        errors = (OSError(errno.ENODEV, os.strerror(errno.ENODEV)), ValueError())
+        for size, error in itertools.product((1, 7, chunk_size), errors):
+            ctl.CACHE_CHUNK_SIZE = size
+            with mock.patch('mmap.mmap', side_effect=error):
+                for filename, position in cases:
+                    with self.subTest(filename=filename, size=size, error=error):
+                        obj = get_object(filename)
+                        obj.set_position_from_cache(CACHE_FILE)
+                        self.assertEqual(obj.get_position(), position)
+                with self.subTest(size=size, error=error):
+                    with self.assertRaisesRegex(ctl.CutthelogCacheError, 'line #4'):
+                        get_object('/root/bad_offset').set_position_from_cache(CACHE_FILE)
+
+    def test_count_lines(self):
+        chunk_size = ctl.CACHE_CHUNK_SIZE
+        self.addCleanup(setattr, ctl, 'CACHE_CHUNK_SIZE', chunk_size)
+        for size in (1, 7, chunk_size):
+            ctl.CACHE_CHUNK_SIZE = size
+            self.assertEqual(ctl._count_lines(CACHE_FILE, 0), 0)
+            self.assertEqual(ctl._count_lines(CACHE_FILE, len(CACHE_LINES[0])), 1)
+            self.assertEqual(ctl._count_lines(CACHE_FILE, len(CACHE_CONTENT) + 10),
+                             len(CACHE_LINES))
+
+    def test_cache_for_path_with_delimiter(self):
+        with tempfile.NamedTemporaryFile() as fhandler:
+            ctl.CutTheLog('/root/hello##world', 10, b'abc').save_to_cache(fhandler.name)
+            obj = ctl.CutTheLog('/root/hello##world')
+            obj.set_position_from_cache(fhandler.name)
+            self.assertEqual(obj.get_position(), (10, b'abc\n'))
+
+    def test_find_cache_record(self):
+        cache = b'/a##1##/b##2##x\n/b##3##y\n/c'
+        self.assertEqual(ctl._find_cache_record(cache, b'/a##'), (0, 16))
+        self.assertEqual(ctl._find_cache_record(cache, b'/b##'), (16, 25))
+        self.assertEqual(ctl._find_cache_record(cache, b'/c'), (25, 27))
+        self.assertEqual(ctl._find_cache_record(cache, b'/d##'), (27, 27))
+        self.assertEqual(ctl._find_cache_record(b'', b'/a##'), (0, 0))
 
     def test_save_to_cache(self):
-        def check(filename, position, last_line, cache_lines, delimiter=None):
-            obj = ctl.CutTheLog(filename, position, last_line)
-            with tempfile.NamedTemporaryFile(mode='rb') as fhandler:
-                shutil.copyfile(CACHE_FILE, fhandler.name)
-                obj.save_to_cache(fhandler.name, delimiter=delimiter)
-                self.assertEqual(fhandler.read(), b''.join(cache_lines))
-        check('/root/hello.2', 100, b'Hello, world!\n', CACHE_LINES)
-        check('/root/hello.2', 100, b'Hello, world!', CACHE_LINES)
-        cache_lines = CACHE_LINES[2:3] + CACHE_LINES[:2] + CACHE_LINES[3:]
-        check('/root/hello', 50, b'Hello, world', cache_lines)
-        cache_lines = [b'/root/unable_to_find##10##aaa\n'] + CACHE_LINES
-        check('/root/unable_to_find', 10, b'aaa', cache_lines)
-        cache_lines = [b'/root/hello%%60%%Hello, world\n'] + CACHE_LINES[:-1]
-        check('/root/hello', 60, b'Hello, world', cache_lines, delimiter='%%')
-        cache_lines = [b'/root/bad_offset##88##Good line\n'] + CACHE_LINES[:4] + CACHE_LINES[5:]
-        check('/root/bad_offset', 88, b'Good line\n', cache_lines)
+        def check(filename, position, last_line, cache_content, delimiter=None):
+            with self.subTest(filename=filename, last_line=last_line, delimiter=delimiter):
+                obj = ctl.CutTheLog(filename, position, last_line)
+                cache_file = self.get_cache_file()
+                obj.save_to_cache(cache_file, delimiter=delimiter)
+                with open(cache_file, 'rb') as cache_handler:
+                    self.assertEqual(cache_handler.read(), cache_content)
+        check('/root/hello.2', 100, b'Hello, world!\n', CACHE_CONTENT)
+        check('/root/hello.2', 100, b'Hello, world!', CACHE_CONTENT)
+        check('/root/hello', 50, b'Hello, world', HELLO_FIRST_CACHE_CONTENT)
+        cache_content = b'/root/unable_to_find##10##aaa\n' + CACHE_CONTENT
+        check('/root/unable_to_find', 10, b'aaa', cache_content)
+        cache_content = b'/root/hello%%60%%Hello, world\n' + CACHE_CONTENT[:-len(CACHE_LINES[-1])]
+        check('/root/hello', 60, b'Hello, world', cache_content, delimiter='%%')
+        cache_content = b''.join([b'/root/bad_offset##88##Good line\n'] + CACHE_LINES[:4] +
+                                 CACHE_LINES[5:])
+        check('/root/bad_offset', 88, b'Good line\n', cache_content)
+
+    def test_save_to_cache_without_mmap(self):
+        chunk_size = ctl.CACHE_CHUNK_SIZE
+        self.addCleanup(setattr, ctl, 'CACHE_CHUNK_SIZE', chunk_size)
+        for size in (1, 7, 30):
+            ctl.CACHE_CHUNK_SIZE = size
+            obj = ctl.CutTheLog('/root/hello', 50, b'Hello, world')
+            cache_file = self.get_cache_file()
+            with mock.patch('mmap.mmap', side_effect=ValueError):
+                obj.save_to_cache(cache_file)
+            with open(cache_file, 'rb') as cache_handler:
+                self.assertEqual(cache_handler.read(), HELLO_FIRST_CACHE_CONTENT)
+
+    def test_save_to_cache_with_failed_copy(self):
+        cache_file = self.get_cache_file()
+        obj = ctl.CutTheLog('/root/hello', 50, b'Hello, world')
+        no_space = OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        with mock.patch('cutthelog._write_other_records', side_effect=no_space):
+            with self.assertRaises(ctl.CutthelogCacheError):
+                obj.save_to_cache(cache_file)
+        with open(cache_file, 'rb') as cache_handler:
+            self.assertEqual(cache_handler.read(), CACHE_CONTENT)
+        self.assertEqual(os.listdir(self.cache_dir), ['cache'])
+
+    def test_save_to_new_cache(self):
+        cache_file = os.path.join(self.cache_dir, 'new_cache')
+        self.addCleanup(os.remove, cache_file)
+        ctl.CutTheLog('/root/hello', 50, b'Hello, world').save_to_cache(cache_file)
+        with open(cache_file, 'rb') as cache_handler:
+            self.assertEqual(cache_handler.read(), b'/root/hello##50##Hello, world\n')
+
+    def test_save_to_cache_in_place(self):
+        obj = ctl.CutTheLog('/root/hello', 50, b'Hello, world')
+        with tempfile.NamedTemporaryFile() as fhandler:
+            fhandler.write(CACHE_CONTENT)
+            fhandler.flush()
+            with mock.patch('tempfile.mkstemp', side_effect=OSError(errno.EACCES, 'denied')):
+                obj.save_to_cache(fhandler.name)
+            fhandler.seek(0)
+            self.assertEqual(fhandler.read(), HELLO_FIRST_CACHE_CONTENT)
+
+    def test_save_to_cache_replaces_symlink_target(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache_file = os.path.join(cache_dir, 'cache')
+        cache_link = os.path.join(cache_dir, 'link')
+        shutil.copyfile(CACHE_FILE, cache_file)
+        os.chmod(cache_file, 0o640)
+        os.symlink(cache_file, cache_link)
+        ctl.CutTheLog('/root/hello.2', 100, b'Hello, world!\n').save_to_cache(cache_link)
+        self.assertTrue(os.path.islink(cache_link))
+        self.assertEqual(os.stat(cache_file).st_mode & 0o777, 0o640)
+        self.assertEqual(sorted(os.listdir(cache_dir)), ['cache', 'link'])
+        with open(cache_file, 'rb') as cache_handler:
+            self.assertEqual(cache_handler.read(), CACHE_CONTENT)
 
 
 class TestUtil(unittest.TestCase):
-    cmd_tmpl = 'python3 ./cutthelog.py -c {cache_file} {filename}'
+    interpreter = (sys.executable, '-S')
 
     def setUp(self):
         file_id, self.cache_file = tempfile.mkstemp(prefix='cutthelog_cache_')
@@ -245,16 +512,37 @@ class TestUtil(unittest.TestCase):
         if os.path.exists(self.cache_file):
             os.remove(self.cache_file)
 
-    def run_util(self, filename, cache_file=None):
+    def run_util(self, filename, cache_file=None, in_process=True):
         filename = get_data_file_path(filename)
         cache_file = cache_file or self.cache_file
-        cmd = self.cmd_tmpl.format(cache_file=cache_file, filename=filename)
-        proc = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
-        return (proc.returncode, stdout, stderr)
-
-    def check(self, filename, returncode=0, stdout='', stderr='', cache='', cache_file=None):
-        real_rc, real_stdout, real_stderr = self.run_util(filename, cache_file=cache_file)
+        argv = ['./cutthelog.py', '-c', cache_file, filename]
+        if in_process:
+            return self.run_main(argv)
+        proc = subprocess.run(list(self.interpreter) + argv, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+        return (proc.returncode, proc.stdout, proc.stderr)
+
+    @staticmethod
+    def run_main(argv):
+        stdout = io.TextIOWrapper(io.BytesIO())
+        stderr = io.TextIOWrapper(io.BytesIO())
+        level = logging.root.level
+        with mock.patch('sys.argv', argv), mock.patch('sys.stdout', stdout), \
+                mock.patch('sys.stderr', stderr), mock.patch.object(logging.root, 'handlers', []):
+            try:
+                returncode = ctl.main()
+            except SystemExit as err:
+                returncode = err.code
+            finally:
+                logging.root.setLevel(level)
+        stdout.flush()
+        stderr.flush()
+        return (returncode, stdout.buffer.getvalue(), stderr.buffer.getvalue())
+
+    def check(self, filename, returncode=0, stdout='', stderr='', cache='', cache_file=None,
+              in_process=True):
+        real_rc, real_stdout, real_stderr = self.run_util(filename, cache_file=cache_file,
+                                                          in_process=in_process)
         stdout = stdout if isinstance(stdout, bytes) else stdout.encode()
         stderr = stderr if isinstance(stderr, bytes) else stderr.encode()
         self.assertEqual(real_stdout, stdout)
@@ -277,7 +565,7 @@ class TestUtil(unittest.TestCase):
             filename = fhandler.name
             os.chmod(filename, 0o000)
             stderr = 'ERROR: ' + ctl.NO_PERMISSION % ('read', filename)
-            self.check(filename, returncode=77, stderr=stderr)
+            self.check(filename, returncode=77, stderr=stderr, in_process=False)
 
     def test_one_line_file(self):
         self.check('one_line', stdout=LINES[0], cache=None)
@@ -290,23 +578,25 @@ class TestUtil(unittest.TestCase):
 
     def test_cache_in_no_permission_directory(self):
         cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
         os.chmod(cache_dir, 0o400)
+        self.addCleanup(os.chmod, cache_dir, 0o700)
         cache_file = os.path.join(cache_dir, 'no-such-file')
         stderr = 'ERROR: ' + ctl.NO_PERMISSION % ('read/write', cache_dir)
-        self.check('one_line', returncode=77, cache_file=cache_file, stderr=stderr, cache=None)
-        os.chmod(cache_dir, 0o700)
-        os.rmdir(cache_dir)
+        self.check('one_line', returncode=77, cache_file=cache_file, stderr=stderr, cache=None,
+                   in_process=False)
 
     def test_no_write_perm_cache_file(self):
         with tempfile.NamedTemporaryFile() as fhandler:
             cache_file = fhandler.name
             os.chmod(cache_file, 0o400)
             stderr = 'ERROR: ' + ctl.NO_PERMISSION % ('read/write', cache_file)
-            self.check('one_line', returncode=77, cache_file=cache_file, stderr=stderr, cache=None)
+            self.check('one_line', returncode=77, cache_file=cache_file, stderr=stderr, cache=None,
+                       in_process=False)
 
 
 class TestUtilWithPython2(unittest.TestCase):
-    cmd_tmpl = 'python2 ./cutthelog.py -c {cache_file} {filename}'
+    interpreter = ('python2', '-S')
 
 
 if __name__ == '__main__':